@@ -1,25 +1,25 @@
 #!/usr/bin/env python3
 
 import argparse
-from collections import defaultdict
 import csv
 import json
+from multiprocessing import Pool, cpu_count
 from os.path import basename
+from pathlib import Path
 import re
+import sys
 
 from django.contrib.gis.gdal import DataSource
 from django.contrib.gis.geos import GEOSGeometry
 import requests
 
-COLUMN_POSTCODE = "pcds"
+# Make the mapit_postcodes package importable when this script is run
+# directly from the bin directory:
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
 
-parser = argparse.ArgumentParser(
-    description="Find postcodes that are split across more than one EUR region"
-)
-parser.add_argument("-r", "--regions-shapefile", metavar="REGIONS-SHAPEFILE")
-parser.add_argument("nsul_csv_filenames", metavar="NSUL-CSV-FILE", nargs="+")
+from mapit_postcodes.postcodes import split_postcode  # noqa: E402
 
-args = parser.parse_args()
+COLUMN_POSTCODE = "pcds"
 
 region_code_to_name = {
     "EE": "Eastern Euro Region",
@@ -35,16 +35,14 @@ region_code_to_name = {
     "YH": "Yorkshire and the Humber Euro Region",
 }
 
-# A modified version of one of the regular expressions suggested here:
-#    http://en.wikipedia.org/wiki/Postcodes_in_the_United_Kingdom
-
-postcode_matcher = re.compile(
-    r"^([A-PR-UWYZ]([0-9][0-9A-HJKPS-UW]?|[A-HK-Y][0-9][0-9ABEHMNPRV-Y]?)) *(([0-9])[ABD-HJLNP-UW-Z]{2})$"
-)
+# Record the regions each postcode is found in as a bitmask, with one
+# bit per region code:
+region_code_to_bit = {
+    region_code: 1 << i for i, region_code in enumerate(region_code_to_name)
+}
 
-postcode_to_regions = defaultdict(set)
 
-for csv_filename in args.nsul_csv_filenames:
+def find_postcodes_in_csv(csv_filename):
     print("Processing", csv_filename)
     m = re.search(
         r"NSUL_\w+_\d+_(EE|EM|LN|NE|NW|SC|SE|SW|WA|WM|YH).csv", basename(csv_filename)
@@ -58,40 +56,85 @@ for csv_filename in args.nsul_csv_filenames:
 
     print("Region name is:", region_name)
 
+    postcodes_seen = set()
+    postcodes = set()
+
     with open(csv_filename) as fp:
-        reader = csv.DictReader(fp)
+        reader = csv.reader(fp)
+        postcode_index = next(reader).index(COLUMN_POSTCODE)
         for i, row in enumerate(reader):
             # if i > 0 and (i % 100000 == 0):
             #     print("{0} postcodes processed".format(i))
-            pc = row[COLUMN_POSTCODE]
+            pc = row[postcode_index]
+            # Each file only covers one region, and there's a row for every
+            # UPRN in a postcode, so we only need to look at each postcode
+            # once per file:
+            if pc in postcodes_seen:
+                continue
+            postcodes_seen.add(pc)
             # Exclude Girobank postcodes:
             if pc.startswith("GIR"):
                 continue
             # Exclude rows where the postcode is missing:
             if not pc:
                 continue
-            m = postcode_matcher.search(pc)
-            if not m:
+            parts = split_postcode(pc)
+            if not parts:
                 raise Exception("Couldn't parse postcode:" + pc + "from row" + str(row))
             # Normalize the postcode's format to put a space in the
             # right place:
-            pc = m.group(1) + " " + m.group(3)
-            postcode_to_regions[pc].add(region_code)
-
-cross_region_postcodes = [
-    (postcode, region_codes)
-    for postcode, region_codes in postcode_to_regions.items()
-    if len(region_codes) > 1
-]
-
-cross_region_postcodes.sort()
-
-for postcode, region_codes in cross_region_postcodes:
-    print(f"{postcode} => {sorted(region_codes)}")
-
-# Now output just the outcodes that contain cross-region postcodes
-# so I can use that to selectively regenerate just the data that might
-# be affected by a cross-region postcode bug
-cross_region_outcodes = sorted(set(pc.split()[0] for pc, _ in cross_region_postcodes))
-print("Cross region outcodes are:")
-print(cross_region_outcodes)
+            outcode, inward_code = parts
+            postcodes.add(outcode + " " + inward_code)
+
+    return region_code, postcodes
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Find postcodes that are split across more than one EUR region"
+    )
+    parser.add_argument("-r", "--regions-shapefile", metavar="REGIONS-SHAPEFILE")
+    parser.add_argument("nsul_csv_filenames", metavar="NSUL-CSV-FILE", nargs="+")
+
+    args = parser.parse_args()
+
+    postcode_to_region_bits = {}
+
+    # Each NSUL file is independent, so read them in parallel:
+    with Pool(processes=cpu_count()) as pool:
+        for region_code, postcodes in pool.imap_unordered(
+            find_postcodes_in_csv, args.nsul_csv_filenames
+        ):
+            region_bit = region_code_to_bit[region_code]
+            for pc in postcodes:
+                postcode_to_region_bits[pc] = (
+                    postcode_to_region_bits.get(pc, 0) | region_bit
+                )
+
+    # A postcode is in more than one region if more than one bit is set:
+    cross_region_postcodes = [
+        (
+            postcode,
+            [
+                region_code
+                for region_code, region_bit in region_code_to_bit.items()
+                if region_bits & region_bit
+            ],
+        )
+        for postcode, region_bits in postcode_to_region_bits.items()
+        if region_bits & (region_bits - 1)
+    ]
+
+    cross_region_postcodes.sort()
+
+    for postcode, region_codes in cross_region_postcodes:
+        print(f"{postcode} => {sorted(region_codes)}")
+
+    # Now output just the outcodes that contain cross-region postcodes
+    # so I can use that to selectively regenerate just the data that might
+    # be affected by a cross-region postcode bug. (The postcodes are
+    # normalized, so the outcode is all but the last four characters.)
+    cross_region_outcodes = sorted(set(pc[:-4] for pc, _ in cross_region_postcodes))
+    print("Cross region outcodes are:")
+    print(cross_region_outcodes)
@@ -4,31 +4,57 @@ import argparse
 from collections import defaultdict
 import csv
 import json
+from multiprocessing import Pool, cpu_count, set_start_method
+import os
 from os.path import basename
+from pathlib import Path
 import re
+import sys
+from tempfile import NamedTemporaryFile
 
 from django.contrib.gis.gdal import DataSource
 from django.contrib.gis.geos import GEOSGeometry
 import requests
 
-COLUMN_POSTCODE = "pcds"
+# Make the mapit_postcodes package importable when this script is run
+# directly from the bin directory:
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
 
-MAPIT_BASE_URL = "https://postcodes.mapit.longair.net"
+from mapit_postcodes.postcodes import split_postcode  # noqa: E402
 
-parser = argparse.ArgumentParser(
-    description="Make a list of Scottish postcode sectors that we definitely don't need to clip"
-)
-parser.add_argument("-r", "--regions-shapefile", metavar="REGIONS-SHAPEFILE")
-parser.add_argument("-a", "--mapit-areas-csv", metavar="MAPIT-AREA-CSV")
-parser.add_argument("nsul_csv_filenames", metavar="NSUL-CSV-FILE", nargs="+")
-parser.add_argument("-o", "--output_file", metavar="OUTPUT-JSON-FILE")
+COLUMN_POSTCODE = "pcds"
 
-args = parser.parse_args()
+MAPIT_BASE_URL = "https://postcodes.mapit.longair.net"
 
-with open(args.mapit_areas_csv) as f:
-    sector_to_mapit_area_id = {row[1]: int(row[0]) for row in csv.reader(f)}
+# Reuse the same connection to MapIt for every request
+session = requests.Session()
+
+# These are set up once in the main process before the NSUL files are
+# processed, and inherited by the worker processes:
+cache_directory = None
+sector_to_mapit_area_id = None
+region_name_to_mainland_geom = None
+
+
+def get_area_wkt(mapit_area_id):
+    cache_filename = None
+    if cache_directory:
+        cache_filename = cache_directory / f"{mapit_area_id}.wkt"
+        if cache_filename.exists():
+            return cache_filename.read_text()
+    r = session.get(f"{MAPIT_BASE_URL}/area/{mapit_area_id}.wkt")
+    r.raise_for_status()
+    if cache_filename:
+        # Sectors that straddle regions are fetched by more than one
+        # worker, so write to a temporary file and rename it into place,
+        # rather than letting another worker read a half-written file:
+        with NamedTemporaryFile(
+            "w", dir=cache_directory, suffix=".tmp", delete=False
+        ) as f:
+            f.write(r.text)
+        os.replace(f.name, cache_filename)
+    return r.text
 
-region_to_sectors_within_mainland = defaultdict(list)
 
 region_code_to_name = {
     "EE": "Eastern Euro Region",
@@ -44,14 +70,8 @@ region_code_to_name = {
     "YH": "Yorkshire and the Humber Euro Region",
 }
 
-# A modified version of one of the regular expressions suggested here:
-#    http://en.wikipedia.org/wiki/Postcodes_in_the_United_Kingdom
-
-postcode_matcher = re.compile(
-    r"^([A-PR-UWYZ]([0-9][0-9A-HJKPS-UW]?|[A-HK-Y][0-9][0-9ABEHMNPRV-Y]?)) *(([0-9])[ABD-HJLNP-UW-Z]{2})$"
-)
 
-for csv_filename in args.nsul_csv_filenames:
+def find_inland_sectors_in_csv(csv_filename):
     print("Processing", csv_filename)
     m = re.search(
         r"NSUL_\w+_\d+_(EE|EM|LN|NE|NW|SC|SE|SW|WA|WM|YH).csv", basename(csv_filename)
@@ -65,44 +85,34 @@ for csv_filename in args.nsul_csv_filenames:
 
     print("Region name is:", region_name)
 
-    # ------------------------------------------------------------------------
-    # Load the corresponding boundary of that region of Great Britain. There
-    # are lots of features for Scotland, so we pick the feature with the largest
-    # area.
-
-    regions_ds = DataSource(args.regions_shapefile)
-    regions_layer = next(iter(regions_ds))
-    mainland_geom = max(
-        (
-            feature.geom.geos.transform("4326", clone=True)
-            for feature in regions_layer
-            if feature.get("NAME") == region_name
-        ),
-        key=lambda g: g.area,
-    )
+    # We test lots of sectors against the same boundary, so prepare it:
+    mainland_geom = region_name_to_mainland_geom[region_name].prepared
 
     postcode_sectors_seen = set()
+    sectors_within_mainland = []
 
     with open(csv_filename) as fp:
-        reader = csv.DictReader(fp)
+        reader = csv.reader(fp)
+        postcode_index = next(reader).index(COLUMN_POSTCODE)
         for i, row in enumerate(reader):
             # if i > 0 and (i % 100000 == 0):
             #     print("{0} postcodes processed".format(i))
-            pc = row[COLUMN_POSTCODE]
+            pc = row[postcode_index]
             # Exclude Girobank postcodes:
             if pc.startswith("GIR"):
                 continue
             # Exclude rows where the postcode is missing:
             if not pc:
                 continue
-            m = postcode_matcher.search(pc)
-            if not m:
+            parts = split_postcode(pc)
+            if not parts:
                 raise Exception("Couldn't parse postcode:" + pc + "from row" + str(row))
             # Normalize the postcode's format to put a space in the
             # right place:
-            pc = m.group(1) + " " + m.group(3)
+            outcode, inward_code = parts
+            pc = outcode + " " + inward_code
 
-            sector = m.group(1) + " " + m.group(4)
+            sector = outcode + " " + inward_code[0]
             if sector in postcode_sectors_seen:
                 continue
             postcode_sectors_seen.add(sector)
@@ -111,14 +121,7 @@ for csv_filename in args.nsul_csv_filenames:
                 print("Sector", sector, "not found in MapIt data")
                 continue
 
-            area_kml_url = (
-                MAPIT_BASE_URL
-                + "/area/"
-                + str(sector_to_mapit_area_id[sector])
-                + ".wkt"
-            )
-            r = requests.get(area_kml_url)
-            area_geometry = GEOSGeometry(r.text)
+            area_geometry = GEOSGeometry(get_area_wkt(sector_to_mapit_area_id[sector]))
 
             inside = mainland_geom.contains(area_geometry)
             print(
@@ -128,7 +131,61 @@ for csv_filename in args.nsul_csv_filenames:
                 f"https://postcodes.mapit.longair.net/area/{sector_to_mapit_area_id[sector]}.html",
             )
             if inside:
-                region_to_sectors_within_mainland[region_code].append(sector)
+                sectors_within_mainland.append(sector)
+
+    return region_code, sectors_within_mainland
 
-with open(args.output_file, "w") as f:
-    json.dump(region_to_sectors_within_mainland, f, indent=2)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Make a list of Scottish postcode sectors that we definitely don't need to clip"
+    )
+    parser.add_argument("-r", "--regions-shapefile", metavar="REGIONS-SHAPEFILE")
+    parser.add_argument("-a", "--mapit-areas-csv", metavar="MAPIT-AREA-CSV")
+    parser.add_argument("nsul_csv_filenames", metavar="NSUL-CSV-FILE", nargs="+")
+    parser.add_argument("-o", "--output_file", metavar="OUTPUT-JSON-FILE")
+    parser.add_argument(
+        "-c",
+        "--cache-directory",
+        metavar="CACHE-DIRECTORY",
+        help="Save the WKT of each sector fetched from MapIt here, and reuse it on later runs",
+    )
+
+    args = parser.parse_args()
+
+    if args.cache_directory:
+        cache_directory = Path(args.cache_directory)
+        cache_directory.mkdir(parents=True, exist_ok=True)
+
+    with open(args.mapit_areas_csv) as f:
+        sector_to_mapit_area_id = {row[1]: int(row[0]) for row in csv.reader(f)}
+
+    # --------------------------------------------------------------------
+    # Load the boundary of each region of Great Britain once, before the
+    # NSUL files are processed. There are lots of features for Scotland, so
+    # we pick the feature with the largest area.
+
+    region_name_to_mainland_geom = {}
+    regions_ds = DataSource(args.regions_shapefile)
+    regions_layer = next(iter(regions_ds))
+    for feature in regions_layer:
+        region_name = feature.get("NAME")
+        geom = feature.geom.geos.transform("4326", clone=True)
+        existing_geom = region_name_to_mainland_geom.get(region_name)
+        if existing_geom is None or geom.area > existing_geom.area:
+            region_name_to_mainland_geom[region_name] = geom
+
+    region_to_sectors_within_mainland = defaultdict(list)
+
+    # Each NSUL file is independent, so check them in parallel. The workers
+    # rely on inheriting the globals set up above, so make sure they're
+    # started with fork even where that isn't the default (e.g. on macOS):
+    set_start_method("fork", force=True)
+    with Pool(processes=cpu_count()) as pool:
+        for region_code, sectors in pool.imap(
+            find_inland_sectors_in_csv, args.nsul_csv_filenames
+        ):
+            region_to_sectors_within_mainland[region_code] += sectors
+
+    with open(args.output_file, "w") as f:
+        json.dump(region_to_sectors_within_mainland, f, indent=2)
@@ -1,7 +1,6 @@
 #!/usr/bin/env python3
 
 import argparse
-from collections import defaultdict
 import csv
 import errno
 import json
@@ -9,17 +8,25 @@ import math
 from multiprocessing import Pool, cpu_count
 import os
 from os.path import basename, join, splitext
+from pathlib import Path
 import re
+import sys
 
 from django.contrib.gis.geos import Point, Polygon
 from django.contrib.gis.gdal import DataSource
 from lxml import etree
 import numpy as np
-from scipy.spatial import Voronoi, voronoi_plot_2d
+from scipy.spatial import Voronoi
 from tqdm import tqdm
 
 from mapit.management.command_utils import fix_invalid_geos_geometry
 
+# Make the mapit_postcodes package importable when this script is run
+# directly from the bin directory:
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from mapit_postcodes.postcodes import split_postcode  # noqa: E402
+
 COLUMN_POSTCODE = "pcds"
 COLUMN_E = "gridgb1e"
 COLUMN_N = "gridgb1n"
@@ -51,14 +58,17 @@ if __name__ == '__main__':
     args = parser.parse_args()
     required_pc_prefix = args.startswith
 
-    # A modified version of one of the regular expressions suggested here:
-    #    http://en.wikipedia.org/wiki/Postcodes_in_the_United_Kingdom
-
-    postcode_matcher = re.compile(
-        r'^([A-PR-UWYZ]([0-9][0-9A-HJKPS-UW]?|[A-HK-Y][0-9][0-9ABEHMNPRV-Y]?)) *([0-9][ABD-HJLNP-UW-Z]{2})$'
-    )
+    # Keep one entry per NSUL row in these lists, which are turned into
+    # NumPy arrays once everything's been read. Postcodes are replaced by
+    # an index into the postcodes list.
+    row_eastings = []
+    row_northings = []
+    row_postcode_ids = []
+    row_uprns = []
 
-    position_to_uprns_and_postcodes = defaultdict(set)
+    postcodes = []
+    postcode_outcodes = []
+    postcode_to_id = {}
 
     total_postcodes = 0
 
@@ -72,11 +82,16 @@ if __name__ == '__main__':
         print("Region name is:", region_name)
 
         with open(csv_filename) as fp:
-            reader = csv.DictReader(fp)
+            reader = csv.reader(fp)
+            header = next(reader)
+            postcode_index = header.index(COLUMN_POSTCODE)
+            e_index = header.index(COLUMN_E)
+            n_index = header.index(COLUMN_N)
+            uprn_index = header.index(COLUMN_UPRN)
             for i, row in enumerate(reader):
                 if i > 0 and (i % 10000 == 0):
                     print("{0} postcodes processed".format(i))
-                pc = row[COLUMN_POSTCODE]
+                pc = row[postcode_index]
                 if required_pc_prefix and not pc.startswith(required_pc_prefix):
                     continue
                 # Exclude Girobank postcodes:
@@ -85,27 +100,54 @@ if __name__ == '__main__':
                 # Exclude rows where the postcode is missing:
                 if not pc:
                     continue
-                m = postcode_matcher.search(pc)
-                if not m:
+                parts = split_postcode(pc)
+                if not parts:
                     raise Exception("Couldn't parse postcode:" + pc + "from row" + str(row))
                 # Normalize the postcode's format to put a space in the
                 # right place:
-                pc = m.group(1) + " " + m.group(3)
+                outcode, inward_code = parts
+                pc = outcode + " " + inward_code
                 # Remove commas from the eastings and northings
-                row[COLUMN_E] = re.sub(r',', '', row[COLUMN_E])
-                row[COLUMN_N] = re.sub(r',', '', row[COLUMN_N])
-                lon = int(re.sub(r',', '', row[COLUMN_E]))
-                lat = int(re.sub(r',', '', row[COLUMN_N]))
-                position_tuple = (lon, lat)
-                position_to_uprns_and_postcodes[position_tuple].add((pc, row[COLUMN_UPRN]))
-
-    for position, postcodes_and_uprns in position_to_uprns_and_postcodes.items():
-        if len(postcodes_and_uprns) <= 1:
-            continue
-        outcodes = set()
-        for postcode, uprn in postcodes_and_uprns:
-            outcode = postcode.split()[0]
-            outcodes.add(outcode)
+                lon = int(row[e_index].replace(',', ''))
+                lat = int(row[n_index].replace(',', ''))
+                postcode_id = postcode_to_id.get(pc)
+                if postcode_id is None:
+                    postcode_id = postcode_to_id[pc] = len(postcodes)
+                    postcodes.append(pc)
+                    postcode_outcodes.append(outcode)
+                row_eastings.append(lon)
+                row_northings.append(lat)
+                row_postcode_ids.append(postcode_id)
+                row_uprns.append(row[uprn_index])
+
+    row_eastings = np.array(row_eastings, dtype=np.int64)
+    row_northings = np.array(row_northings, dtype=np.int64)
+    row_postcode_ids = np.array(row_postcode_ids, dtype=np.int64)
+
+    # Sort the rows by position, and find the runs of rows in that order
+    # which are at the same position:
+    order = np.lexsort((row_northings, row_eastings))
+    sorted_eastings = row_eastings[order]
+    sorted_northings = row_northings[order]
+    starts_new_position = np.ones(len(order), dtype=bool)
+    starts_new_position[1:] = (np.diff(sorted_eastings) != 0) | (np.diff(sorted_northings) != 0)
+    run_starts = np.flatnonzero(starts_new_position)
+    run_ends = np.append(run_starts[1:], len(order))
+    shared_position = (run_ends - run_starts) > 1
+    run_starts = run_starts[shared_position]
+    run_ends = run_ends[shared_position]
+
+    # lexsort is stable, so the first row of each run is the one that
+    # appeared first in the NSUL files. Report the positions in that order,
+    # rather than sorted by position, so that the output still follows the
+    # input:
+    first_seen_order = np.argsort(order[run_starts], kind='stable')
+
+    for start, end in zip(run_starts[first_seen_order], run_ends[first_seen_order]):
+        row_indices = order[start:end]
+        outcodes = set(postcode_outcodes[i] for i in np.unique(row_postcode_ids[row_indices]))
         if len(outcodes) > 1:
+            position = (int(sorted_eastings[start]), int(sorted_northings[start]))
+            postcodes_and_uprns = set((postcodes[row_postcode_ids[i]], row_uprns[i]) for i in row_indices)
             print("Multiple outcodes in a vertical street!")
             print(position, postcodes_and_uprns)
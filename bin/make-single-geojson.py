@@ -4,6 +4,23 @@ import json
 from pathlib import Path
 import sys
 
+# This is how fast_geojson_output in mapit_postcodes_union_postcode_regions
+# starts and ends each file; if an input file looks like that, we can copy
+# its features into the output without parsing them.
+FEATURE_COLLECTION_START = b'{"type": "FeatureCollection", "features": ['
+FEATURE_COLLECTION_END = b']}'
+
+
+def get_features_bytes(input_filename):
+    data = input_filename.read_bytes()
+    if data.startswith(FEATURE_COLLECTION_START) and data.endswith(FEATURE_COLLECTION_END):
+        return data[len(FEATURE_COLLECTION_START):-len(FEATURE_COLLECTION_END)]
+    # Otherwise fall back to parsing and reserializing the features:
+    outcode_data = json.loads(data)
+    return b",".join(
+        json.dumps(feature, sort_keys=True).encode() for feature in outcode_data["features"]
+    )
+
 
 if len(sys.argv) != 2:
     print(f"Usage: {sys.argv[0]} DIRECTORY", file=sys.stderr)
@@ -17,16 +34,16 @@ if not (outcodes_directory.exists() and outcodes_directory.is_dir()):
 
 outcode_geojson_filenames = sorted(outcodes_directory.glob("*/*.geojson"))
 
-with open("all-individual-postcodes.geojson", "w") as fw:
-    fw.write('{"type": "FeatureCollection", "features": [')
+with open("all-individual-postcodes.geojson", "wb") as fw:
+    fw.write(b'{"type": "FeatureCollection", "features": [')
     first_feature = True
     for input_filename in outcode_geojson_filenames:
-        with open(input_filename) as f:
-            outcode_data = json.load(f)
-        for feature in outcode_data["features"]:
-            if first_feature:
-                first_feature = False
-            else:
-                fw.write(",")
-            json.dump(feature, fw, sort_keys=True)
-    fw.write(']}')
+        features_bytes = get_features_bytes(input_filename)
+        if not features_bytes:
+            continue
+        if first_feature:
+            first_feature = False
+        else:
+            fw.write(b",")
+        fw.write(features_bytes)
+    fw.write(b']}')
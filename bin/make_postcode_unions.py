@@ -1,13 +1,15 @@
 #!/usr/bin/env python3
 
-from __future__ import unicode_literals, print_function
-
 import argparse
+from collections import defaultdict
+from functools import partial
 import json
+from multiprocessing import Pool, cpu_count
 from pathlib import Path
 import re
 
-from django.contrib.gis.geos import GEOSGeometry, GeometryCollection
+from django.contrib.gis.gdal import DataSource
+from django.contrib.gis.geos import GeometryCollection
 
 postcode_re = re.compile(
     r"(?P<outcode>[A-PR-UWYZ]([0-9][0-9A-HJKPS-UW]?|[A-HK-Y][0-9][0-9ABEHMNPRV-Y]?)) *"
@@ -20,9 +22,80 @@ def postcode_to_sector(pc):
     return m.group("outcode") + " " + m.group("sector")
 
 
-def postcode_to_district(pc):
-    m = postcode_re.search(pc)
-    return m.group("outcode")
+def outcode_to_area(outcode):
+    # The postcode area is the letters before the first digit of the outcode
+    for i, c in enumerate(outcode):
+        if c.isdigit():
+            return outcode[:i]
+    return outcode
+
+
+def union_geometries(geometries):
+    # A single geometry has already been unioned at the previous level, so
+    # there's no need to wrap it in a collection and union it again:
+    if len(geometries) == 1:
+        return geometries[0]
+    return GeometryCollection(*geometries).unary_union
+
+
+def output_area_geojson(directory, area_type_singular, area, unioned):
+    directory.mkdir(parents=True, exist_ok=True)
+    with open(directory / f"{area}.geojson", "w") as fw:
+        # Write GEOS's GeoJSON for the geometry straight into the output,
+        # rather than parsing it only to serialize it again:
+        fw.write('{"type": "FeatureCollection", "features": [')
+        fw.write('{"type": "Feature", "geometry": ')
+        fw.write(unioned.json)
+        fw.write(f', "properties": {json.dumps({area_type_singular: area})}')
+        fw.write("}]}")
+
+
+def process_outcode_file(outcode_filename):
+    outcodes_directory = outcode_filename.parent.parent
+    outcode = outcode_filename.with_suffix("").name
+    print("===", outcode, "(sectors and districts)")
+    # Let GDAL read the GeoJSON straight into geometries, rather than parsing
+    # it with json and then serializing each geometry again for GEOS:
+    outcode_layer = DataSource(str(outcode_filename))[0]
+    # Build the sectors from the individual postcodes, and then the
+    # districts from those sectors rather than from the postcodes again,
+    # so that each district union works on a few already-merged polygons.
+    # Each postcode is only parsed once, as its feature is read.
+    sector_to_geometries = defaultdict(list)
+    for feature in outcode_layer:
+        sector = postcode_to_sector(feature.get("postcodes"))
+        sector_to_geometries[sector].append(feature.geom.geos)
+    district_to_sector_geometries = defaultdict(list)
+    for sector, geometries in sorted(sector_to_geometries.items()):
+        unioned = union_geometries(geometries)
+        output_area_geojson(
+            outcodes_directory.parent / "sectors" / outcode,
+            "sector",
+            sector,
+            unioned,
+        )
+        district = sector.rpartition(" ")[0]
+        district_to_sector_geometries[district].append(unioned)
+    for district, sector_geometries in sorted(district_to_sector_geometries.items()):
+        unioned = union_geometries(sector_geometries)
+        output_area_geojson(
+            outcodes_directory.parent / "districts" / outcode,
+            "district",
+            district,
+            unioned,
+        )
+
+
+def process_area(outcodes_directory, area):
+    print("===", area, "(area)")
+    districts_directory = outcodes_directory.parent / "districts"
+    filenames = districts_directory.glob(area + "[0-9]*/*.geojson")
+    geos_geometries = []
+    for filename in filenames:
+        district_feature = DataSource(str(filename))[0][0]
+        geos_geometries.append(district_feature.geom.geos)
+    unioned = union_geometries(geos_geometries)
+    output_area_geojson(outcodes_directory.parent / "areas", "area", area, unioned)
 
 
 if __name__ == "__main__":
@@ -35,72 +108,19 @@ if __name__ == "__main__":
     args = parser.parse_args()
 
     outcodes_directory = Path(args.outcodes_directory)
-    outcode_filenames = outcodes_directory.glob("*/*.geojson")
-
-    for outcode_filename in sorted(outcode_filenames):
-        outcode = outcode_filename.with_suffix("").name
-        print("===", outcode, "(sectors and districts)")
-        with open(outcode_filename) as f:
-            outcode_data = json.load(f)
-        features = [
-            {
-                "postcode": feature["properties"]["postcodes"],
-                "geos_geometry": GEOSGeometry(json.dumps(feature["geometry"])),
-            }
-            for feature in outcode_data["features"]
-        ]
-        for area_type, area_type_singular, extract_fn in [
-            ("sectors", "sector", postcode_to_sector),
-            ("districts", "district", postcode_to_district),
-        ]:
-            areas_directory = outcodes_directory.parent / area_type
-            distinct_areas = sorted(set(extract_fn(f["postcode"]) for f in features))
-            for area in distinct_areas:
-                gc = GeometryCollection(
-                    *[
-                        f["geos_geometry"]
-                        for f in features
-                        if f["postcode"].startswith(area)
-                    ]
-                )
-                unioned = gc.unary_union
-                areas_outcode_directory = areas_directory / outcode
-                areas_outcode_directory.mkdir(parents=True, exist_ok=True)
-                area_output_filename = areas_outcode_directory / f"{area}.geojson"
-                with open(area_output_filename, "w") as fw:
-                    fw.write('{"type": "FeatureCollection", "features": [')
-                    feature = {
-                        "geometry": json.loads(unioned.json),
-                        "properties": {area_type.rstrip("s"): area},
-                    }
-                    fw.write(json.dumps(feature))
-                    fw.write("]}")
-
-    outcode_filenames = outcodes_directory.glob("*/*.geojson")
+    outcode_filenames = sorted(outcodes_directory.glob("*/*.geojson"))
+
     outcodes = sorted(
         outcode_filename.with_suffix("").name for outcode_filename in outcode_filenames
     )
-    areas = sorted(set(re.sub(r"\d.*", "", outcode) for outcode in outcodes))
-    areas_directory = outcodes_directory.parent / "areas"
-    areas_directory.mkdir(parents=True, exist_ok=True)
-    for area in areas:
-        print("===", area, "(area)")
-        districts_directory = outcodes_directory.parent / "districts"
-        filenames = districts_directory.glob(area + "[0-9]*/*.geojson")
-        geos_geometries = []
-        for filename in filenames:
-            with open(filename) as f:
-                district_data = json.load(f)
-            geos_geometries.append(
-                GEOSGeometry(json.dumps(district_data["features"][0]["geometry"]))
-            )
-        gc = GeometryCollection(*geos_geometries)
-        unioned = gc.unary_union
-        with open(areas_directory / f"{area}.geojson", "w") as fw:
-            fw.write('{"type": "FeatureCollection", "features": [')
-            feature = {
-                "geometry": json.loads(unioned.json),
-                "properties": {"area": area},
-            }
-            fw.write(json.dumps(feature))
-            fw.write("]}")
+    areas = sorted(set(outcode_to_area(outcode) for outcode in outcodes))
+    (outcodes_directory.parent / "areas").mkdir(parents=True, exist_ok=True)
+
+    # Each outcode (and then each area) can be unioned independently, so
+    # spread them over all the CPUs, using the same worker processes for
+    # both levels:
+    with Pool(processes=cpu_count()) as pool:
+        for _ in pool.imap_unordered(process_outcode_file, outcode_filenames):
+            pass
+        for _ in pool.imap_unordered(partial(process_area, outcodes_directory), areas):
+            pass
@@ -1,5 +1,5 @@
-from __future__ import unicode_literals, print_function
-
+import argparse
+from bisect import bisect_right
 import json
 import os
 from os.path import join
@@ -7,8 +7,12 @@ import re
 
 from django.core.management.base import LabelCommand, CommandError
 from django.core.management import call_command
+from django.db import transaction
+
+from mapit.management.commands.mapit_import import Command as MapItImportCommand
+from mapit.models import Area, Code, CodeType, Generation, NameType, Type
 
-from mapit.models import Area, CodeType, Generation, NameType, Type
+BATCH_SIZE = 500
 
 
 def without_spaces(s):
@@ -32,6 +36,18 @@ class Command(LabelCommand):
 
         name_type = NameType.objects.get(code="uk-pc-name")
 
+        # Reuse one instance of the mapit_import command for every file,
+        # and work out its options once (below), rather than having
+        # call_command look it up by name, build its argument parser and
+        # parse the options again for each file:
+        mapit_import_command = MapItImportCommand()
+        mapit_import_parser = mapit_import_command.create_parser("", "mapit_import")
+        mapit_import_defaults = {
+            action.dest: action.default
+            for action in mapit_import_parser._actions
+            if action.option_strings and action.default is not argparse.SUPPRESS
+        }
+
         postcodes_geojson_directory = options["postcodes_geojson_directory"]
 
         for type_code, relative_geojson_directory, code_type_code in [
@@ -65,41 +81,54 @@ class Command(LabelCommand):
             if len(possible_last) > 0:
                 last_imported = possible_last[0].name
 
+            command_kwargs = {
+                "generation_id": generation.id,
+                "area_type_code": area_type.code,
+                "name_type_code": name_type.code,
+                # Postcode units sometimes overlap between countries of the UK,
+                # so just use the country field to say "United Kingdom"
+                "country_code": "U",
+                "name_field": name_field,
+                "code_field": "mapit_code",
+                "code_type": code_type.code,
+                "encoding": None,
+                "commit": True,
+                "new": False,
+                "use_code_as_id": False,
+                "fix_invalid_polygons": False,
+                "preserve": True,
+            }
+            import_options = {
+                **mapit_import_defaults,
+                **command_kwargs,
+                # call_command skips the system checks too:
+                "skip_checks": True,
+            }
+
             for root, dirs, filenames in os.walk(geojson_directory):
                 dirs.sort()
-                filenames.sort()
-                for filename in filenames:
-                    m = re.search(r"^(.*)\.geojson$", filename)
-                    if not m:
-                        continue
-                    postcode = m.group(1)
-                    if last_imported is not None and postcode <= last_imported:
-                        continue
+                postcodes = sorted(
+                    filename[: -len(".geojson")]
+                    for filename in filenames
+                    if filename.endswith(".geojson")
+                )
+                # If we're restarting, skip straight past the postcodes that
+                # have already been imported:
+                if last_imported is not None:
+                    postcodes = postcodes[bisect_right(postcodes, last_imported) :]
+                for postcode in postcodes:
                     if postcode.startswith("point-"):
                         continue
                     print("doing postcode:", postcode)
 
-                    full_filename = os.path.join(root, filename)
-
-                    command_kwargs = {
-                        "generation_id": generation.id,
-                        "area_type_code": area_type.code,
-                        "name_type_code": name_type.code,
-                        # Postcode units sometimes overlap between countries of the UK,
-                        # so just use the country field to say "United Kingdom"
-                        "country_code": "U",
-                        "name_field": name_field,
-                        "code_field": "mapit_code",
-                        "code_type": code_type.code,
-                        "encoding": None,
-                        "commit": True,
-                        "new": False,
-                        "use_code_as_id": False,
-                        "fix_invalid_polygons": False,
-                        "preserve": True,
-                    }
-
-                    call_command("mapit_import", full_filename, **command_kwargs)
+                    full_filename = os.path.join(root, postcode + ".geojson")
+
+                    # Commit once per file, so that each file's areas, names
+                    # and codes are either all imported or not at all. If the
+                    # import fails part way through, the check above for the
+                    # last imported postcode finds where to restart from.
+                    with transaction.atomic():
+                        mapit_import_command.execute(full_filename, **import_options)
 
         # Now handle the cases where there are multiple postcodes at a
         # single point. Change the main name, and add additional codes
@@ -107,29 +136,29 @@ class Command(LabelCommand):
         postcodes_directory = join(postcodes_geojson_directory, "postcodes")
         code_type = CodeType.objects.get(code="uk-pc")
         name_type = NameType.objects.get(code="uk-pc-name")
+        # Look up the area for every postcode in one query, rather than
+        # fetching each one separately:
+        code_to_area_id = dict(
+            Code.objects.filter(type=code_type).values_list("code", "area_id")
+        )
+        areas_to_update = []
         for root, dirs, filenames in os.walk(postcodes_directory):
             dirs.sort()
             filenames.sort()
             for filename in filenames:
-                m = re.search("^(.*)\.json$", filename)
-                if not m:
+                if not filename.endswith(".json"):
                     continue
-                primary_postcode = m.group(1)
+                primary_postcode = filename[: -len(".json")]
                 full_filename = join(root, filename)
-                if not full_filename.endswith(".json"):
-                    continue
                 with open(full_filename) as f:
                     all_postcodes = json.load(f)
                 assert primary_postcode == all_postcodes[0]
                 # Find the area this refers to from the primary code:
-                area = Area.objects.get(
-                    codes__type__code="uk-pc",
-                    codes__code=without_spaces(primary_postcode),
-                )
+                area_id = code_to_area_id[without_spaces(primary_postcode)]
                 # Now change its name to include all the postcodes for
                 # that area:
                 joined = ", ".join(all_postcodes)
                 if len(joined) > 2000:
                     joined = re.sub(r",([^,]*)$", " ...", joined[:1996])
-                area.name = joined
-                area.save()
+                areas_to_update.append(Area(id=area_id, name=joined))
+        Area.objects.bulk_update(areas_to_update, ["name"], batch_size=BATCH_SIZE)
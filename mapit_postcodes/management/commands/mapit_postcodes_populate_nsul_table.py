@@ -1,18 +1,20 @@
-from collections import defaultdict
 import csv
+from io import StringIO
 import math
 from os.path import basename
 import re
+from xml.sax.saxutils import escape
 
-from django.contrib.gis.geos import Point, Polygon
+from django.contrib.gis.geos import Polygon
 from django.contrib.gis.gdal import DataSource
 from django.core.management.base import BaseCommand
-from lxml import etree
+from django.db import connection
 import numpy as np
 from scipy.spatial import Voronoi
 from tqdm import tqdm
 
 from mapit_postcodes.models import VoronoiRegion, NSULRow
+from mapit_postcodes.postcodes import split_postcode
 
 COLUMN_POSTCODE = "pcds"
 COLUMN_E = "gridgb1e"
@@ -45,22 +47,24 @@ region_code_to_name = {
 }
 
 
-def output_postcode_points_kml(filename, postcodes_and_points):
-    kml = etree.Element("kml", nsmap={None: "http://earth.google.com/kml/2.1"})
-    document = etree.SubElement(kml, "Document")
-    for postcode, wgs84_point in postcodes_and_points:
-        placemark = etree.SubElement(document, "Placemark")
-        name = etree.SubElement(placemark, "name")
-        name.text = postcode
-        point = etree.SubElement(placemark, "Point")
-        coordinates = etree.SubElement(point, "coordinates")
-        coordinates.text = "{0.x},{0.y}".format(wgs84_point)
-    with open(filename, "wb") as f:
-        f.write(
-            etree.tostring(
-                kml, pretty_print=True, encoding="utf-8", xml_declaration=True
-            )
-        )
+KML_PLACEMARK_TEMPLATE = """<Placemark>
+  <name>{name}</name>
+  <Point>
+    <coordinates>{x},{y}</coordinates>
+  </Point>
+</Placemark>
+"""
+
+
+def output_postcode_points_kml(filename, postcodes_and_coordinates):
+    # Every Placemark has the same structure, so just write each one out
+    # from a template rather than building lxml elements for them.
+    with open(filename, "w", encoding="utf-8") as f:
+        f.write("<?xml version='1.0' encoding='utf-8'?>\n")
+        f.write('<kml xmlns="http://earth.google.com/kml/2.1"><Document>\n')
+        for postcode, x, y in postcodes_and_coordinates:
+            f.write(KML_PLACEMARK_TEMPLATE.format(name=escape(postcode), x=x, y=y))
+        f.write("</Document></kml>\n")
 
 
 class Command(BaseCommand):
@@ -89,8 +93,6 @@ class Command(BaseCommand):
         )
 
     def handle(self, **options):
-        # FIXME: it might be best to drop the index on the postcode column before
-        # and adding it again at the end in a `finally:` block
         if options["force_delete"]:
             NSULRow.objects.all().delete()
             VoronoiRegion.objects.all().delete()
@@ -111,39 +113,70 @@ class Command(BaseCommand):
                 )
                 return
 
+        # Drop the indexes on the NSUL rows table while the rows are being
+        # inserted, and create them again at the end; building each index
+        # once is much quicker than updating it for every row.
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "select indexname, indexdef from pg_indexes "
+                + "where tablename = 'mapit_postcodes_nsulrow' "
+                + "and indexname not in (select conname from pg_constraint)"
+            )
+            index_definitions = cursor.fetchall()
+        # Keep track of the indexes that have actually been dropped, so that
+        # if dropping one of them fails, the ones before it still get
+        # recreated:
+        dropped_index_definitions = []
+        try:
+            with connection.cursor() as cursor:
+                for index_name, index_definition in index_definitions:
+                    cursor.execute(f'drop index "{index_name}"')
+                    dropped_index_definitions.append(index_definition)
+            self.populate_nsul_rows(options)
+        finally:
+            print("Recreating the indexes on mapit_postcodes_nsulrow")
+            with connection.cursor() as cursor:
+                for index_definition in dropped_index_definitions:
+                    cursor.execute(index_definition)
+
+    def populate_nsul_rows(self, options):
         required_pc_prefix = options["startswith"]
 
         # ------------------------------------------------------------------------
 
-        # A modified version of one of the regular expressions suggested here:
-        #    http://en.wikipedia.org/wiki/Postcodes_in_the_United_Kingdom
+        # The rows waiting to be inserted, as (postcode, eastings, northings,
+        # UPRN, region code) tuples. The Voronoi command reads the positions
+        # back from the database, so there's no need to keep anything else
+        # about each row here, or to build a GEOS Point for each one.
+        new_rows = []
+
+        def insert_batch_of_new_rows():
+            # Send the batch to PostgreSQL with COPY, giving each point as
+            # EWKT, rather than going through NSULRow objects and bulk_create:
+            copy_data = StringIO()
+            for postcode, e, n, uprn, row_region_code in new_rows:
+                copy_data.write(
+                    f"SRID=27700;POINT({e} {n})\t{postcode}\t{uprn}\t{row_region_code}\n"
+                )
+            copy_data.seek(0)
+            with connection.cursor() as cursor:
+                cursor.copy_expert(
+                    "copy mapit_postcodes_nsulrow (point, postcode, uprn, region_code) from stdin",
+                    copy_data,
+                )
+            new_rows.clear()
 
-        postcode_matcher = re.compile(
-            r"^([A-PR-UWYZ]([0-9][0-9A-HJKPS-UW]?|[A-HK-Y][0-9][0-9ABEHMNPRV-Y]?)) *([0-9][ABD-HJLNP-UW-Z]{2})$"
-        )
+        # Load the boundaries of the regions of Great Britain once, rather
+        # than reopening and scanning the shapefile for every CSV file:
 
-        positions_list = []
-
-        position_to_row_ids = defaultdict(set)
-        position_to_row_objects = defaultdict(list)
-
-        def bulk_create_batch_of_new_row_objects():
-            nonlocal position_to_row_ids, position_to_row_objects
-            nr_to_create = []
-            for position_tuple, row_objects in position_to_row_objects.items():
-                nr_to_create += row_objects
-            NSULRow.objects.bulk_create(nr_to_create)
-            # bulk_create modifies the passed in objects to set the primary key on
-            # them - we only need the IDs at this stage, so copy them to the more
-            # compact data structure.
-            for position_tuple, row_objects in position_to_row_objects.items():
-                position_to_row_ids[position_tuple].update(
-                    [row_object.id for row_object in row_objects]
-                )
-            # Now we can clear position_to_row_objects
-            position_to_row_objects = defaultdict(list)
+        regions_ds = DataSource(options["regions_shapefile"])
+        if len(regions_ds) != 1:
+            raise Exception("Expected the regions shapefile to only have one layer")
+        regions_layer = next(iter(regions_ds))
 
-        wgs84_postcode_and_points = []
+        region_name_to_geom = {}
+        for feature in regions_layer:
+            region_name_to_geom[feature.get("NAME")] = feature.geom.geos
 
         gb_region_geoms = {}
 
@@ -162,19 +195,10 @@ class Command(BaseCommand):
 
             print("Region name is:", region_name)
 
-            # ------------------------------------------------------------------------
-            # Load the corresponding boundary of that region of Great Britain, so we
-            # can clip the postcode regions that cross that boundary.
+            # Find the corresponding boundary of that region of Great Britain,
+            # so we can clip the postcode regions that cross that boundary.
 
-            regions_ds = DataSource(options["regions_shapefile"])
-            if len(regions_ds) != 1:
-                raise Exception("Expected the regions shapefile to only have one layer")
-            regions_layer = next(iter(regions_ds))
-
-            gb_region_geom = None
-            for feature in regions_layer:
-                if feature.get("NAME") == region_name:
-                    gb_region_geom = feature.geom.geos
+            gb_region_geom = region_name_to_geom.get(region_name)
             if not gb_region_geom:
                 raise Exception(
                     f"Failed to find the geometry of ‘{region_name}’ in {options['regions_shapefile']}"
@@ -183,13 +207,18 @@ class Command(BaseCommand):
             gb_region_geoms[region_code] = gb_region_geom
 
             with open(csv_filename) as fp:
-                reader = csv.DictReader(fp)
+                reader = csv.reader(fp)
+                header = next(reader)
+                postcode_index = header.index(COLUMN_POSTCODE)
+                e_index = header.index(COLUMN_E)
+                n_index = header.index(COLUMN_N)
+                uprn_index = header.index(COLUMN_UPRN)
                 for i, row in enumerate(reader):
                     if i > 0 and (i % 100000 == 0):
                         print("{0} postcodes processed".format(i))
                     if i > 0 and (i % BATCH_SIZE == 0):
-                        bulk_create_batch_of_new_row_objects()
-                    pc = row[COLUMN_POSTCODE]
+                        insert_batch_of_new_rows()
+                    pc = row[postcode_index]
                     if required_pc_prefix and not pc.startswith(required_pc_prefix):
                         continue
                     # Exclude Girobank postcodes:
@@ -198,40 +227,29 @@ class Command(BaseCommand):
                     # Exclude rows where the postcode is missing:
                     if not pc:
                         continue
-                    m = postcode_matcher.search(pc)
-                    if not m:
+                    parts = split_postcode(pc)
+                    if not parts:
                         raise Exception(
                             "Couldn't parse postcode:" + pc + "from row" + str(row)
                         )
                     # Normalize the postcode's format to put a space in the
                     # right place:
-                    pc = m.group(1) + " " + m.group(3)
+                    outcode, inward_code = parts
+                    pc = outcode + " " + inward_code
                     # Remove commas from the eastings and northings
-                    row[COLUMN_E] = re.sub(r",", "", row[COLUMN_E])
-                    row[COLUMN_N] = re.sub(r",", "", row[COLUMN_N])
-                    lon = int(re.sub(r",", "", row[COLUMN_E]))
-                    lat = int(re.sub(r",", "", row[COLUMN_N]))
-                    osgb_point = Point(lon, lat, srid=27700)
-
-                    new_row = NSULRow(
-                        point=osgb_point,
-                        postcode=pc,
-                        uprn=row[COLUMN_UPRN],
-                        region_code=region_code,
-                    )
-
-                    if options["postcode_points"]:
-                        wgs84_point = osgb_point.transform(4326, clone=True)
-                        wgs84_postcode_and_points.append((pc, wgs84_point))
-                    position_tuple = (lon, lat)
-                    if (
-                        position_tuple not in position_to_row_ids
-                        and position_tuple not in position_to_row_objects
-                    ):
-                        positions_list.append((lon, lat))
-                    position_to_row_objects[position_tuple].append(new_row)
-
-            bulk_create_batch_of_new_row_objects()
+                    lon = int(row[e_index].replace(",", ""))
+                    lat = int(row[n_index].replace(",", ""))
+                    new_rows.append((pc, lon, lat, row[uprn_index], region_code))
+
+            insert_batch_of_new_rows()
 
         if options["postcode_points"]:
-            output_postcode_points_kml("postcode-points.kml", wgs84_postcode_and_points)
+            # Have PostGIS transform all the points to WGS84 in one query,
+            # rather than transforming them in Python as they're read:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "select postcode, st_x(wgs84_point), st_y(wgs84_point) from "
+                    + "(select id, postcode, st_transform(point, 4326) as wgs84_point "
+                    + "from mapit_postcodes_nsulrow) as t order by id"
+                )
+                output_postcode_points_kml("postcode-points.kml", cursor)
@@ -1,6 +1,8 @@
-from collections import defaultdict
 import csv
+from functools import partial
+from io import StringIO
 import math
+from multiprocessing import Pool, set_start_method
 from os.path import basename
 import re
 
@@ -16,6 +18,7 @@ from tqdm import tqdm
 from mapit_postcodes.models import VoronoiRegion, NSULRow
 
 BATCH_SIZE = 1000
+FETCH_BATCH_SIZE = 100000
 
 # This doesn't need to be in any sense precise - it's used for the centre
 # of our ring of "points at infinity". Taken from:
@@ -27,6 +30,171 @@ UK_MAX_NORTHINGS = 1219109
 UK_MIN_NORTHINGS = 3706
 
 
+def process_region(region_code, required_pc_prefix=None):
+    # Each forked process has to reopen the database connection, so close it
+    # in each child to force reopening
+    connection.close()
+
+    print("===== Processing region", region_code)
+
+    # Read the primary key and position of every row in the region
+    # from the mapit_postcodes_nsulrow table in one query, noting
+    # which of them were selected. (Asking PostGIS for the coordinates
+    # avoids creating a model instance and a GEOS Point for every row.)
+    # The rows are fetched in batches through a server-side cursor, and
+    # each batch is turned into arrays straight away, so that there's
+    # only ever one batch of row tuples in memory rather than millions.
+    # (Grid references in metres fit comfortably in 32 bits.)
+    row_id_batches = []
+    row_eastings_batches = []
+    row_northings_batches = []
+    row_selected_batches = []
+    with connection.chunked_cursor() as cursor:
+        cursor.execute(
+            "select id, st_x(point), st_y(point), postcode "
+            + "from mapit_postcodes_nsulrow where region_code = %s",
+            [region_code],
+        )
+        while True:
+            rows = cursor.fetchmany(FETCH_BATCH_SIZE)
+            if not rows:
+                break
+            row_id_batches.append(
+                np.fromiter((row[0] for row in rows), np.int64, len(rows))
+            )
+            row_eastings_batches.append(
+                np.fromiter((row[1] for row in rows), np.int32, len(rows))
+            )
+            row_northings_batches.append(
+                np.fromiter((row[2] for row in rows), np.int32, len(rows))
+            )
+            row_selected_batches.append(
+                np.fromiter(
+                    (
+                        not required_pc_prefix or row[3].startswith(required_pc_prefix)
+                        for row in rows
+                    ),
+                    bool,
+                    len(rows),
+                )
+            )
+    row_ids = np.concatenate(row_id_batches)
+    row_eastings = np.concatenate(row_eastings_batches)
+    row_northings = np.concatenate(row_northings_batches)
+    row_selected = np.concatenate(row_selected_batches)
+    del row_id_batches, row_eastings_batches, row_northings_batches, row_selected_batches
+    print(f"{region_code}: Read {len(row_ids)} rows from the database")
+
+    # Sort the rows by position so that all the rows at a position
+    # are next to each other, then find where each run of rows at
+    # the same position starts and ends. Each run gives one of the
+    # unique positions that go into the Voronoi diagram.
+    order = np.lexsort((row_northings, row_eastings))
+    row_ids = row_ids[order]
+    row_eastings = row_eastings[order]
+    row_northings = row_northings[order]
+    row_selected = row_selected[order]
+
+    position_changes = (np.diff(row_eastings) != 0) | (np.diff(row_northings) != 0)
+    run_starts = np.flatnonzero(np.concatenate(([True], position_changes)))
+    run_ends = np.append(run_starts[1:], len(row_ids))
+    positions = np.column_stack((row_eastings[run_starts], row_northings[run_starts]))
+
+    # Now add some "points at infinity" - 200 points in a circle way
+    # outside the border of the United Kingdom:
+
+    points_at_infinity = 200
+
+    distance_to_infinity = (UK_MAX_NORTHINGS - UK_MIN_NORTHINGS) * 1.5
+
+    angles = np.linspace(0, 2 * math.pi, points_at_infinity, endpoint=False)
+    infinity_points = np.column_stack(
+        (
+            CENTRE_OF_GB_E + np.cos(angles) * distance_to_infinity,
+            CENTRE_OF_GB_N + np.sin(angles) * distance_to_infinity,
+        )
+    )
+
+    # The points at infinity go after all the real positions, so the
+    # loop over positions below never reaches them:
+    points = np.concatenate((positions, infinity_points))
+    print(f"{region_code}: Calculating the Voronoi diagram...")
+    vor = Voronoi(points)
+    print(f"{region_code}: Finished!")
+
+    # Now put the Voronoi polygons into the database, and set up foreign keys
+    # from the NSUL rows. Batch them up so that we can use bulk_create and
+    # bulk_update.
+
+    # The (NSUL row ID, Voronoi region ID) pairs to set, in the format
+    # that COPY expects:
+    nr_vr_ids_to_update = StringIO()
+
+    total_positions = len(positions)
+    with tqdm(total=total_positions) as progress:
+        for start_index in range(0, total_positions, BATCH_SIZE):
+            n = min(BATCH_SIZE, total_positions - start_index)
+            # print(f"{region_code}: Processing batch from index", start_index, "to", start_index + n - 1, "inclusive")
+
+            nr_list = []
+            vr_to_create = []
+            for i in range(start_index, start_index + n):
+                run = slice(run_starts[i], run_ends[i])
+                selected_row_ids = row_ids[run][row_selected[run]]
+                if len(selected_row_ids) == 0:
+                    # None of the rows at this position were selected - ignore it
+                    continue
+
+                voronoi_region_index = vor.point_region[i]
+                voronoi_region = vor.regions[voronoi_region_index]
+                if any(vi < 0 for vi in voronoi_region):
+                    # Then this region extends to infinity, so is outside our "points at infinity"
+                    continue
+                if len(voronoi_region) < 3:
+                    # Skip any point with fewer than 3 triangle_indices
+                    continue
+
+                # Index the vertices array with the whole region at once,
+                # repeating the first vertex to close the ring:
+                border = vor.vertices[voronoi_region + voronoi_region[:1]]
+                polygon = Polygon(border, srid=27700)
+
+                voronoi_region_object = VoronoiRegion(polygon=polygon)
+                vr_to_create.append(voronoi_region_object)
+
+                nr_list.append(selected_row_ids)
+
+            vr_created = VoronoiRegion.objects.bulk_create(vr_to_create)
+            for i, voronoi_region in enumerate(vr_created):
+                for nsul_row_id in nr_list[i]:
+                    nr_vr_ids_to_update.write(f"{nsul_row_id}\t{voronoi_region.id}\n")
+
+            progress.update(n)
+
+    # The update was incredibly slow, so I'm trying the technique here to see if
+    # it helps https://stackoverflow.com/a/24811058/223092 - load all the
+    # pairs for the region into a temporary table with COPY, and then
+    # set the foreign keys with a single update.
+    if nr_vr_ids_to_update.tell() > 0:
+        print(f"{region_code}: Setting the Voronoi regions of the NSUL rows...")
+        nr_vr_ids_to_update.seek(0)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "create temporary table tmp (nsul_row_id integer, voronoi_region_id integer)"
+            )
+            cursor.copy_expert(
+                "copy tmp (nsul_row_id, voronoi_region_id) from stdin",
+                nr_vr_ids_to_update,
+            )
+            cursor.execute("analyze tmp")
+            cursor.execute(
+                "update mapit_postcodes_nsulrow nr set voronoi_region_id = tmp.voronoi_region_id from tmp where nr.id = tmp.nsul_row_id"
+            )
+            # Not strictly necessary since it's a temporary table, but this saves me
+            # having to figure out the database session lifetime
+            cursor.execute("drop table tmp")
+
+
 class Command(BaseCommand):
     help = "Generate Voronoi polygons from NSUL postcode coordinates"
 
@@ -37,6 +205,13 @@ class Command(BaseCommand):
             metavar="PREFIX",
             help="Only process postcodes that start with PREFIX",
         )
+        parser.add_argument(
+            "-j",
+            "--jobs",
+            type=int,
+            default=1,
+            help="Process this many regions at once (each needs a lot of memory)",
+        )
 
     def handle(self, **options):
         # FIXME: it might be best to drop the index on the postcode column before
@@ -48,116 +223,19 @@ class Command(BaseCommand):
         # 64GB machine. (This is bad for the very few postcodes that cross
         # EU region boundaries, but I can live with that for the moment.)
 
-        for region_code in NSULRow.objects.values_list(
-            "region_code", flat=True
-        ).distinct():
-            print("===== Processing region", region_code)
-
-            positions_list = []
-            position_to_row_ids = defaultdict(set)
-
-            # Get the unique positions from the mapit_postcodes_nsulrow table
-            # into a list, storing the corresponding primary key of all the rows
-            # that refer to that position.
-
-            rows_processed = 0
-            for nsul_row in NSULRow.objects.filter(region_code=region_code).iterator(
-                chunk_size=BATCH_SIZE
+        region_codes = list(
+            NSULRow.objects.values_list("region_code", flat=True).distinct()
+        )
+        # The regions are independent of each other, so if there's enough
+        # memory, their Voronoi diagrams can be calculated in parallel. The
+        # workers need to inherit Django's set up from this process, so
+        # make sure they're started with fork even where that isn't the
+        # default (e.g. on macOS):
+        set_start_method("fork", force=True)
+        connection.close()
+        with Pool(processes=options["jobs"]) as pool:
+            for _ in pool.imap_unordered(
+                partial(process_region, required_pc_prefix=required_pc_prefix),
+                region_codes,
             ):
-                position_tuple = (int(nsul_row.point.x), int(nsul_row.point.y))
-                positions_list.append(position_tuple)
-                rows_processed += 1
-                if (rows_processed % 100000) == 0:
-                    print(
-                        f"{region_code}: Read {rows_processed} rows from the database"
-                    )
-                if required_pc_prefix and not nsul_row.startswith(required_pc_prefix):
-                    continue
-                position_to_row_ids[position_tuple].add(nsul_row.id)
-
-            # Now add some "points at infinity" - 200 points in a circle way
-            # outside the border of the United Kingdom:
-
-            points_at_infinity = 200
-
-            distance_to_infinity = (UK_MAX_NORTHINGS - UK_MIN_NORTHINGS) * 1.5
-
-            for i in range(0, points_at_infinity):
-                angle = (2 * math.pi * i) / float(points_at_infinity)
-                new_x = CENTRE_OF_GB_E + math.cos(angle) * distance_to_infinity
-                new_y = CENTRE_OF_GB_N + math.sin(angle) * distance_to_infinity
-                positions_list.append((new_x, new_y))
-
-            points = np.array(positions_list)
-            print(f"{region_code}: Calculating the Voronoi diagram...")
-            vor = Voronoi(points)
-            print(f"{region_code}: Finished!")
-
-            # Now put the Voronoi polygons into the database, and set up foreign keys
-            # from the NSUL rows. Batch them up so that we can use bulk_create and
-            # bulk_update.
-
-            total_positions = len(positions_list)
-            with tqdm(total=total_positions) as progress:
-                for start_index in range(0, total_positions, BATCH_SIZE):
-                    n = min(BATCH_SIZE, total_positions - start_index)
-                    # print(f"{region_code}: Processing batch from index", start_index, "to", start_index + n - 1, "inclusive")
-
-                    nr_list = []
-                    vr_to_create = []
-                    for i in range(start_index, start_index + n):
-                        position_tuple = positions_list[i]
-                        row_ids = position_to_row_ids[position_tuple]
-                        if not row_ids:
-                            # This is one of the "points at infinity" - ignore them
-                            continue
-
-                        voronoi_region_index = vor.point_region[i]
-                        voronoi_region = vor.regions[voronoi_region_index]
-                        if any(vi < 0 for vi in voronoi_region):
-                            # Then this region extends to infinity, so is outside our "points at infinity"
-                            continue
-                        if len(voronoi_region) < 3:
-                            # Skip any point with fewer than 3 triangle_indices
-                            return
-
-                        border = [vor.vertices[i] for i in voronoi_region]
-                        border.append(border[0])
-                        # The coordinates are NumPy arrays, so convert them to tuples:
-                        border = [tuple(p) for p in border]
-                        polygon = Polygon(border, srid=27700)
-
-                        voronoi_region_object = VoronoiRegion(polygon=polygon)
-                        vr_to_create.append(voronoi_region_object)
-
-                        nr_list.append(row_ids)
-
-                    nr_vr_ids_to_update = []
-                    vr_created = VoronoiRegion.objects.bulk_create(vr_to_create)
-                    for i, voronoi_region in enumerate(vr_created):
-                        for nsul_row_id in nr_list[i]:
-                            nr_vr_ids_to_update.append((nsul_row_id, voronoi_region.id))
-
-                    # The update was incredibly slow, so I'm trying the technique here to see if
-                    # it helps https://stackoverflow.com/a/24811058/223092
-                    if len(nr_vr_ids_to_update) > 0:
-                        with connection.cursor() as cursor:
-                            cursor.execute(
-                                "create temporary table tmp (nsul_row_id integer, voronoi_region_id integer)"
-                            )
-                            insert_query = (
-                                "insert into tmp (nsul_row_id, voronoi_region_id) values "
-                                + ", ".join(
-                                    f"({nr_id}, {vr_id})"
-                                    for nr_id, vr_id in nr_vr_ids_to_update
-                                )
-                            )
-                            cursor.execute(insert_query)
-                            cursor.execute(
-                                "update mapit_postcodes_nsulrow nr set voronoi_region_id = tmp.voronoi_region_id from tmp where nr.id = tmp.nsul_row_id"
-                            )
-                            # Not strictly necessary since it's a temporary table, but this saves me
-                            # having to figure out the database session lifetime
-                            cursor.execute("drop table tmp")
-
-                    progress.update(n)
+                pass
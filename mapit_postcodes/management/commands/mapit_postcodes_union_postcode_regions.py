@@ -1,19 +1,16 @@
-import errno
 from functools import partial
+from itertools import groupby
 import json
 from multiprocessing import Pool, cpu_count, set_start_method
-import os
 from pathlib import Path
 import re
 
 from django.db import connection
-from django.contrib.gis.db.models import Collect
-from django.contrib.gis.geos import GeometryCollection, GEOSGeometry, Point
-from django.contrib.gis.gdal import DataSource
+from django.contrib.gis.geos import GeometryCollection, GEOSGeometry
+from django.contrib.gis.gdal import CoordTransform, DataSource, SpatialReference
 from django.core.management.base import BaseCommand, CommandError
 
 from mapit.management.command_utils import fix_invalid_geos_geometry
-from mapit_postcodes.models import VoronoiRegion, NSULRow
 
 from tqdm import tqdm
 
@@ -34,20 +31,37 @@ region_name_to_code = {v: k for k, v in region_code_to_name.items()}
 
 inland_sectors_by_region_code = None
 region_code_to_geometry_cache = {}
+region_code_to_prepared_geometry_cache = {}
+region_code_to_extent_cache = {}
 postcodes_output_directory = None
 only_single_area = None
 
+# Setting up a coordinate transformation is relatively expensive, so
+# create this once rather than passing an SRID to every transform() call:
+osgb_to_wgs84 = CoordTransform(SpatialReference(27700), SpatialReference(4326))
+
 MAPIT_CODE_KEY = "mapit_code"
 
+OUTPUT_BUFFER_SIZE = 1 << 20
+
+# json.dumps creates a new encoder on every call when it's given any
+# options, so make the one used for each feature's properties once:
+properties_encoder = json.JSONEncoder(sort_keys=True)
+
+
+def init_worker():
+    # Each forked process has to reopen the database connection, so close it
+    # in each child to force reopening. Doing this once when the worker
+    # starts, rather than in every task, means each worker only connects
+    # once.
+    connection.close()
 
-def mkdir_p(path):
-    try:
-        os.makedirs(path)
-    except OSError as exc:
-        if exc.errno == errno.EEXIST:
-            pass
-        else:
-            raise
+
+def get_chunksize(number_of_tasks):
+    # Send tasks to the pool's workers in chunks to cut down on the
+    # inter-process communication, while still leaving several chunks per
+    # worker so that a few slow tasks don't hold everything up.
+    return max(1, number_of_tasks // (cpu_count() * 8))
 
 
 def get_subpath(level, prefix):
@@ -56,16 +70,19 @@ def get_subpath(level, prefix):
     elif level == "districts":
         return Path(f"{prefix}.geojson")
     elif level == "sectors":
-        return Path(re.sub(" .*", "", prefix)) / f"{prefix}.geojson"
+        return Path(prefix.partition(" ")[0]) / f"{prefix}.geojson"
     else:
         raise Exception(f"Unknown postcode level “{level}”")
 
 
-SECTOR_RE = r"(^\S+ \S).*"
-
-
-def postcode_to_sector(postcode):
-    return re.sub(SECTOR_RE, "\\1", postcode)
+def postcode_to_sector(postcode_or_prefix):
+    # The sector is the outcode, a space and the first character of the
+    # inward code, e.g. "SW1A 1" for "SW1A 1AA". Prefixes for areas and
+    # districts don't include a sector, so return None for those.
+    outcode, _, inward_code = postcode_or_prefix.partition(" ")
+    if not outcode or not inward_code or inward_code[0].isspace():
+        return None
+    return outcode + " " + inward_code[0]
 
 
 def get_region_geometry(region_code):
@@ -75,35 +92,54 @@ def get_region_geometry(region_code):
     raise Exception(f"There was no cached geometry for '{region_code}'")
 
 
+def get_prepared_region_geometry(region_code):
+    # A prepared geometry builds an index of the region's edges the first
+    # time it's used, so that each point-in-polygon test afterwards doesn't
+    # have to scan every vertex of the coastline.
+    cached = region_code_to_prepared_geometry_cache.get(region_code)
+    if cached:
+        return cached
+    raise Exception(f"There was no cached prepared geometry for '{region_code}'")
+
+
+def get_region_extent(region_code):
+    cached = region_code_to_extent_cache.get(region_code)
+    if cached:
+        return cached
+    raise Exception(f"There was no cached extent for '{region_code}'")
+
+
 def polygon_requires_clipping(polygon, region_code, postcode_or_prefix):
-    usable_postcode_or_prefix = postcode_or_prefix and re.search(
-        SECTOR_RE, postcode_or_prefix
-    )
-    if inland_sectors_by_region_code is not None and usable_postcode_or_prefix:
+    if inland_sectors_by_region_code is not None and postcode_or_prefix:
         # Then in some cases we can skip the expensive later
         # check.
         postcode_sector = postcode_to_sector(postcode_or_prefix)
         if postcode_sector in inland_sectors_by_region_code[region_code]:
             return False
 
-    # Check whether any of the points in the polygon or
-    # multipolygon are in the sea - if so, we need to clip the
-    # polygon to the coastline
-    geom_type = polygon.geom_type
-    if geom_type == "MultiPolygon":
-        polygons = polygon.coords
-    elif geom_type == "Polygon":
-        polygons = [polygon.coords]
-    else:
-        raise Exception("Unknown geom_type {0}".format(geom_type))
-    region_geometry = get_region_geometry(region_code)
-    for p in polygons:
-        for t in p:
-            for x, y in t:
-                point = Point(x, y)
-                if not region_geometry.contains(point):
-                    return True
-    return False
+    # If the polygon's bounding box pokes out of the region's bounding box
+    # then some of it must be outside the region, which we can tell just by
+    # comparing the coordinates:
+    region_xmin, region_ymin, region_xmax, region_ymax = get_region_extent(region_code)
+    xmin, ymin, xmax, ymax = polygon.extent
+    if (
+        xmin < region_xmin
+        or ymin < region_ymin
+        or xmax > region_xmax
+        or ymax > region_ymax
+    ):
+        return True
+
+    prepared_region_geometry = get_prepared_region_geometry(region_code)
+    # Most polygons are nowhere near the coast, and if the region contains
+    # the polygon's bounding box then it must contain the polygon too.
+    if prepared_region_geometry.contains(polygon.envelope):
+        return False
+    # Otherwise check whether any part of the polygon or multipolygon is
+    # in the sea - if so, we need to clip the polygon to the coastline.
+    # This is a single call into GEOS, which uses the prepared geometry's
+    # index of the coastline's edges.
+    return not prepared_region_geometry.covers(polygon)
 
 
 def drop_non_polygons(geometry_collection):
@@ -118,9 +154,9 @@ def drop_non_polygons(geometry_collection):
 def clip_unioned(polygon, region_code, postcode_or_prefix=None):
     if not polygon_requires_clipping(polygon, region_code, postcode_or_prefix):
         return polygon
-    gb_region_geom = get_region_geometry(region_code)
-    if not polygon.intersects(gb_region_geom):
+    if not get_prepared_region_geometry(region_code).intersects(polygon):
         return polygon
+    gb_region_geom = get_region_geometry(region_code)
     after_intersection = polygon.intersection(gb_region_geom)
     # There are some rare situations where the intersection produces a
     # GeometryCollection instead of a Polygon or MultiPolygon because
@@ -132,44 +168,61 @@ def clip_unioned(polygon, region_code, postcode_or_prefix=None):
         return after_intersection
 
 
+def union_polygons_per_region(polygons_per_region):
+    # Almost every postcode (and most higher level areas) is only in one
+    # region, in which case there's nothing to union.
+    if len(polygons_per_region) == 1:
+        return polygons_per_region[0]
+    return GeometryCollection(*polygons_per_region).unary_union
+
+
 def fast_geojson_output(output_filename, postcodes_and_polygons):
-    with open(output_filename, "w") as f:
+    # Use a larger buffer than the default so that writing an outcode's
+    # features takes a handful of system calls rather than thousands:
+    with open(output_filename, "w", buffering=OUTPUT_BUFFER_SIZE) as f:
         f.write('{"type": "FeatureCollection", "features": [')
         first_item = True
         for properties, polygon in postcodes_and_polygons:
             if not first_item:
                 f.write(",")
-            f.write('{"type": "Feature", "geometry": ')
-            f.write(polygon.json)
-            f.write(f', "properties": {json.dumps(properties, sort_keys=True)}')
-            f.write("}")
+            f.write(
+                '{"type": "Feature", "geometry": '
+                + polygon.json
+                + ', "properties": '
+                + properties_encoder.encode(properties)
+                + "}"
+            )
             first_item = False
         f.write("]}")
 
 
 def process_vertical_street(vertical_street_row):
-    # Each forked process has to reopen the database connection, so close it
-    # in each child to force reopening
-    connection.close()
-
-    point_wkt, postcodes, region_codes, uprns, voronoi_region_id = vertical_street_row
+    (
+        x,
+        y,
+        postcodes,
+        region_codes,
+        uprns,
+        voronoi_region_id,
+        voronoi_region_hexewkb,
+    ) = vertical_street_row
 
     if len(region_codes) > 1:
-        print(f"Multiple region codes found (!!!) at {point_wkt}")
+        print(f"Multiple region codes found (!!!) at POINT({x} {y})")
         return
     region_code = region_codes[0]
 
-    output_directory = postcodes_output_directory / "vertical-streets"
-    mkdir_p(output_directory)
+    eastings = int(x)
+    northings = int(y)
 
-    point = GEOSGeometry(point_wkt, srid=27700)
-    eastings = int(point.x)
-    northings = int(point.y)
+    output_directory = postcodes_output_directory / "vertical-streets"
 
-    original_polyon = VoronoiRegion.objects.get(pk=voronoi_region_id).polygon
+    original_polyon = GEOSGeometry(voronoi_region_hexewkb)
 
-    clipped = clip_unioned(original_polyon, region_code)
-    wgs_84_clipped_polygon = clipped.transform(4326, clone=True)
+    # Nothing else refers to the clipped polygon, so transform it in place
+    # rather than making a copy of it:
+    wgs_84_clipped_polygon = clip_unioned(original_polyon, region_code)
+    wgs_84_clipped_polygon.transform(osgb_to_wgs84)
     # If the polygon isn't valid after transformation, try to
     # fix it. (There has been at least one such case with the old dataset.
     if not wgs_84_clipped_polygon.valid:
@@ -199,44 +252,42 @@ def process_vertical_street(vertical_street_row):
 
 
 def process_outcode(outcode):
-    # Each forked process has to reopen the database connection, so close it
-    # in each child to force reopening
-    connection.close()
-
     output_directory = postcodes_output_directory / "units"
-    mkdir_p(output_directory)
-    # Deal with individual postcodes first, leaving vertical streets to later:
-    qs = NSULRow.objects.values("postcode").filter(postcode__startswith=(outcode + " "))
-    qs = qs.order_by("postcode").distinct()
-    postcodes = [row["postcode"] for row in qs]
+    # Deal with individual postcodes first, leaving vertical streets to later.
+    # Collect the Voronoi regions for every postcode in the outcode (split
+    # by the region they're in) with a single query, rather than running
+    # separate queries for each postcode. All the UPRNs at one point share
+    # a Voronoi region, so only collect each region once per postcode
+    # rather than once per UPRN, which would give unary_union lots of
+    # duplicate polygons to get rid of:
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "select n.postcode, n.region_code, ST_AsHEXEWKB(ST_Collect(v.polygon)) "
+            + "from (select distinct postcode, region_code, voronoi_region_id "
+            + "from mapit_postcodes_nsulrow where postcode like %s) as n "
+            + "join mapit_postcodes_voronoiregion v on v.id = n.voronoi_region_id "
+            + "group by n.postcode, n.region_code "
+            + "order by n.postcode, n.region_code",
+            [outcode + " %"],
+        )
+        result = cursor.fetchall()
 
     postcode_multipolygons = []
-    for row in qs:
-        postcode = row["postcode"]
-        region_codes = list(
-            NSULRow.objects.filter(postcode=postcode)
-            .values_list("region_code", flat=True)
-            .distinct()
-        )
-        result = (
-            VoronoiRegion.objects.filter(nsulrow__postcode=postcode)
-            .values("nsulrow__region_code")
-            .annotate(collected=Collect("polygon"))
-        )
+    for postcode, rows in groupby(result, key=lambda row: row[0]):
         union_results = [
             {
-                "region_code": row["nsulrow__region_code"],
-                "unioned": row["collected"].unary_union,
+                "region_code": region_code,
+                "unioned": GEOSGeometry(collected_hexewkb).unary_union,
             }
-            for row in result
+            for _, region_code, collected_hexewkb in rows
         ]
 
         final_polygons_per_region = []
         for union_result in union_results:
             region_code = union_result["region_code"]
             unioned = union_result["unioned"]
-            clipped = clip_unioned(unioned, region_code, postcode)
-            wgs_84_clipped_polygon = clipped.transform(4326, clone=True)
+            wgs_84_clipped_polygon = clip_unioned(unioned, region_code, postcode)
+            wgs_84_clipped_polygon.transform(osgb_to_wgs84)
             # If the polygon isn't valid after transformation, try to
             # fix it. (There has been at least one such case with the old dataset.
             if not wgs_84_clipped_polygon.valid:
@@ -251,14 +302,13 @@ def process_outcode(outcode):
                 final_polygons_per_region.append(wgs_84_clipped_polygon)
 
         if len(final_polygons_per_region) > 0:
-            gc = GeometryCollection(*final_polygons_per_region)
             postcode_multipolygons.append(
                 (
                     {
                         "postcodes": postcode,
                         MAPIT_CODE_KEY: re.sub(r"\s+", "", postcode),
                     },
-                    gc.unary_union,
+                    union_polygons_per_region(final_polygons_per_region),
                 )
             )
 
@@ -268,40 +318,39 @@ def process_outcode(outcode):
 
 
 def process_level(postcode_level, prefix):
-    # Each forked process has to reopen the database connection, so close it
-    # in each child to force reopening
-    connection.close()
-
-    outcode_subdir = re.sub(" .*$", "", prefix)
     output_directory = postcodes_output_directory / postcode_level["plural"]
-    mkdir_p(output_directory)
     # Deal with individual postcodes first, leaving vertical streets to later:
     postcode_regex = postcode_level["query_dict_particular_area_re_format"].format(
         prefix=prefix
     )
-    qs = NSULRow.objects.values("postcode").filter(postcode__regex=postcode_regex)
-    qs = qs.order_by("postcode").distinct()
-    postcodes = [row["postcode"] for row in qs]
-
-    result = (
-        VoronoiRegion.objects.filter(nsulrow__postcode__in=postcodes)
-        .values("nsulrow__region_code")
-        .annotate(collected=Collect("polygon"))
-    )
+    # Filter the Voronoi regions on the postcode pattern directly, rather
+    # than fetching the distinct matching postcodes first and sending them
+    # all back to the database in an IN clause. As for individual postcodes,
+    # only collect each Voronoi region once, however many UPRNs share it:
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "select n.region_code, ST_AsHEXEWKB(ST_Collect(v.polygon)) "
+            + "from (select distinct region_code, voronoi_region_id "
+            + "from mapit_postcodes_nsulrow where postcode ~ %s) as n "
+            + "join mapit_postcodes_voronoiregion v on v.id = n.voronoi_region_id "
+            + "group by n.region_code",
+            [postcode_regex],
+        )
+        result = cursor.fetchall()
     union_results = [
         {
-            "region_code": row["nsulrow__region_code"],
-            "unioned": row["collected"].unary_union,
+            "region_code": region_code,
+            "unioned": GEOSGeometry(collected_hexewkb).unary_union,
         }
-        for row in result
+        for region_code, collected_hexewkb in result
     ]
 
     final_polygons_per_region = []
     for union_result in union_results:
         region_code = union_result["region_code"]
         unioned = union_result["unioned"]
-        clipped = clip_unioned(unioned, region_code, prefix)
-        wgs_84_clipped_polygon = clipped.transform(4326, clone=True)
+        wgs_84_clipped_polygon = clip_unioned(unioned, region_code, prefix)
+        wgs_84_clipped_polygon.transform(osgb_to_wgs84)
         # If the polygon isn't valid after transformation, try to
         # fix it. (There has been at least one such case with the old dataset.
         if not wgs_84_clipped_polygon.valid:
@@ -315,19 +364,17 @@ def process_level(postcode_level, prefix):
 
     final_multipolygons = []
     if len(final_polygons_per_region) > 0:
-        gc = GeometryCollection(*final_polygons_per_region)
         final_multipolygons.append(
             (
                 {
                     postcode_level["singular"]: prefix,
                     MAPIT_CODE_KEY: re.sub(r"\s+", "", prefix),
                 },
-                gc.unary_union,
+                union_polygons_per_region(final_polygons_per_region),
             )
         )
 
     output_filename = output_directory / get_subpath(postcode_level["plural"], prefix)
-    output_filename.parent.mkdir(parents=True, exist_ok=True)
 
     fast_geojson_output(output_filename, final_multipolygons)
 
@@ -352,7 +399,7 @@ class Command(BaseCommand):
         parser.add_argument("--skip-vertical-streets", action="store_true")
 
     def handle(self, **options):
-        global inland_sectors_by_region_code, region_code_to_geometry_cache, postcodes_output_directory
+        global inland_sectors_by_region_code, postcodes_output_directory
 
         # Ensure the output directory exists
         if not options["output_directory"]:
@@ -360,7 +407,7 @@ class Command(BaseCommand):
                 "You must specify an output directory with -o or --output-directory"
             )
         postcodes_output_directory = Path(options["output_directory"])
-        mkdir_p(postcodes_output_directory)
+        postcodes_output_directory.mkdir(parents=True, exist_ok=True)
 
         # If a JSON file indicating which postcode sectors are inland has been
         # supplied, then load it:
@@ -398,7 +445,27 @@ class Command(BaseCommand):
                 raise CommandError(
                     f"There were multiple regions for {region_code} ({region_name}) in the regions shapefile"
                 )
-            region_code_to_geometry_cache[region_code] = feature.geom.geos
+            region_geometry = feature.geom.geos
+            region_code_to_geometry_cache[region_code] = region_geometry
+            region_code_to_extent_cache[region_code] = region_geometry.extent
+            prepared_region_geometry = region_geometry.prepared
+            # GEOS builds a prepared geometry's indexes lazily, when they're
+            # first used: a point locator for points, and an index of the
+            # coastline's edges for anything else, which is what contains(),
+            # covers() and intersects() on polygons rely on. Build both here
+            # by testing a small polygon, rather than having every forked
+            # worker process build its own copy of the edge index.
+            prepared_region_geometry.covers(region_geometry.point_on_surface.buffer(1))
+            region_code_to_prepared_geometry_cache[region_code] = (
+                prepared_region_geometry
+            )
+
+        # The worker processes rely on inheriting the cached region
+        # geometries (and their prepared indexes) from this process, rather
+        # than having them pickled and sent to each one, so make sure that
+        # they're started with fork even where that isn't the default (e.g.
+        # on macOS):
+        set_start_method("fork", force=True)
 
         if not options["skip_individual_postcodes"]:
 
@@ -406,7 +473,7 @@ class Command(BaseCommand):
             print("Finding all the outcodes to process...")
             with connection.cursor() as cursor:
                 cursor.execute(
-                    "select distinct regexp_replace(postcode, ' .*', '') from mapit_postcodes_nsulrow"
+                    "select distinct split_part(postcode, ' ', 1) from mapit_postcodes_nsulrow"
                 )
                 outcodes = [row[0] for row in cursor.fetchall()]
 
@@ -418,9 +485,16 @@ class Command(BaseCommand):
                         f"You said to only process the area {only_single_area} but no outcodes were found for that area"
                     )
 
-            pool = Pool(processes=cpu_count())
+            # Create the output directory once here rather than in every
+            # worker call:
+            (postcodes_output_directory / "units").mkdir(exist_ok=True)
+
+            pool = Pool(processes=cpu_count(), initializer=init_worker)
             for _ in tqdm(
-                pool.imap_unordered(process_outcode, outcodes), total=len(outcodes)
+                pool.imap_unordered(
+                    process_outcode, outcodes, chunksize=get_chunksize(len(outcodes))
+                ),
+                total=len(outcodes),
             ):
                 pass
             connection.close()
@@ -436,7 +510,7 @@ class Command(BaseCommand):
                 {
                     "singular": "district",
                     "plural": "districts",
-                    "query_all_areas": "select distinct regexp_replace(postcode, ' .*', '') from mapit_postcodes_nsulrow",
+                    "query_all_areas": "select distinct split_part(postcode, ' ', 1) from mapit_postcodes_nsulrow",
                     "query_dict_particular_area_re_format": "^{prefix} ",
                 },
                 {
@@ -457,10 +531,26 @@ class Command(BaseCommand):
                             f"You said to only process the area {only_single_area} but no {postcode_level['plural']} were found for that area"
                         )
                 print("++++ Example prefixes:", str(prefixes)[:64])
+                # Create all the output directories for this level up front
+                # rather than in every worker call:
+                level_output_directory = (
+                    postcodes_output_directory / postcode_level["plural"]
+                )
+                for subdirectory in set(
+                    get_subpath(postcode_level["plural"], prefix).parent
+                    for prefix in prefixes
+                ):
+                    (level_output_directory / subdirectory).mkdir(
+                        parents=True, exist_ok=True
+                    )
                 specialized_process_function = partial(process_level, postcode_level)
-                pool = Pool(processes=cpu_count())
+                pool = Pool(processes=cpu_count(), initializer=init_worker)
                 for _ in tqdm(
-                    pool.imap_unordered(specialized_process_function, prefixes),
+                    pool.imap_unordered(
+                        specialized_process_function,
+                        prefixes,
+                        chunksize=get_chunksize(len(prefixes)),
+                    ),
                     total=len(prefixes),
                 ):
                     pass
@@ -473,6 +563,8 @@ class Command(BaseCommand):
                 area_restriction = ""
                 if only_single_area:
                     area_restriction = " where postcode like %(area_like_condition)s"
+                # Fetch each Voronoi region's polygon in the same query, rather
+                # than having the workers look them up one at a time:
                 cursor.execute(
                     "with t as "
                     + "(select point, "
@@ -481,8 +573,10 @@ class Command(BaseCommand):
                     + "array_agg(uprn order by uprn) as uprns, "
                     + "voronoi_region_id "
                     + f"from mapit_postcodes_nsulrow{area_restriction} group by point, voronoi_region_id) "
-                    + "select ST_AsText(point), postcodes, region_codes, uprns, voronoi_region_id "
-                    + " from t where cardinality(postcodes) > 1",
+                    + "select ST_X(point), ST_Y(point), postcodes, region_codes, uprns, voronoi_region_id, "
+                    + "ST_AsHEXEWKB(v.polygon) "
+                    + "from t join mapit_postcodes_voronoiregion v on v.id = t.voronoi_region_id "
+                    + "where cardinality(postcodes) > 1",
                     {
                         "area_like_condition": f"{only_single_area}%"
                         if only_single_area
@@ -491,9 +585,14 @@ class Command(BaseCommand):
                 )
                 rows = cursor.fetchall()
 
-            pool = Pool(processes=cpu_count())
+            (postcodes_output_directory / "vertical-streets").mkdir(exist_ok=True)
+
+            pool = Pool(processes=cpu_count(), initializer=init_worker)
             for _ in tqdm(
-                pool.imap_unordered(process_vertical_street, rows), total=len(rows)
+                pool.imap_unordered(
+                    process_vertical_street, rows, chunksize=get_chunksize(len(rows))
+                ),
+                total=len(rows),
             ):
                 pass
             connection.close()
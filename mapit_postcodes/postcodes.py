@@ -0,0 +1,49 @@
+# split_postcode accepts exactly the postcodes matched by this regular
+# expression, a modified version of one of those suggested here:
+#    http://en.wikipedia.org/wiki/Postcodes_in_the_United_Kingdom
+#
+#   ([A-PR-UWYZ]([0-9][0-9A-HJKPS-UW]?|[A-HK-Y][0-9][0-9ABEHMNPRV-Y]?)) *([0-9][ABD-HJLNP-UW-Z]{2})
+#
+# but checks each character with a set lookup rather than running the
+# regular expression. The characters allowed at each position, from the
+# character classes above, are:
+DIGITS = frozenset("0123456789")
+# [A-PR-UWYZ]
+OUTCODE_FIRST_LETTERS = frozenset("ABCDEFGHIJKLMNOPRSTUWYZ")
+# [A-HK-Y]
+OUTCODE_SECOND_LETTERS = frozenset("ABCDEFGHKLMNOPQRSTUVWXY")
+# [0-9A-HJKPS-UW], after a single letter and a digit, e.g. "W1A"
+OUTCODE_LAST_AFTER_LETTER = DIGITS | frozenset("ABCDEFGHJKPSTUW")
+# [0-9ABEHMNPRV-Y], after two letters and a digit, e.g. "EC1A"
+OUTCODE_LAST_AFTER_LETTERS = DIGITS | frozenset("ABEHMNPRVWXY")
+# [ABD-HJLNP-UW-Z]
+INWARD_CODE_LETTERS = frozenset("ABDEFGHJLNPQRSTUWXYZ")
+
+
+def is_outcode(outcode):
+    length = len(outcode)
+    if not 2 <= length <= 4 or outcode[0] not in OUTCODE_FIRST_LETTERS:
+        return False
+    if outcode[1] in DIGITS:
+        return length == 2 or (length == 3 and outcode[2] in OUTCODE_LAST_AFTER_LETTER)
+    return (
+        length >= 3
+        and outcode[1] in OUTCODE_SECOND_LETTERS
+        and outcode[2] in DIGITS
+        and (length == 3 or outcode[3] in OUTCODE_LAST_AFTER_LETTERS)
+    )
+
+
+def split_postcode(pc):
+    # Returns the outcode and inward code, or None if pc isn't a postcode
+    # (including when it has leading or trailing spaces).
+    outcode, inward_code = pc[:-3].rstrip(" "), pc[-3:]
+    if (
+        len(inward_code) == 3
+        and inward_code[0] in DIGITS
+        and inward_code[1] in INWARD_CODE_LETTERS
+        and inward_code[2] in INWARD_CODE_LETTERS
+        and is_outcode(outcode)
+    ):
+        return outcode, inward_code
+    return None